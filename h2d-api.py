@@ -1,9 +1,14 @@
 #!/usr/bin/python3
 
-from flask import Flask, jsonify, request
+import atexit
+import signal
+import sys
+
+from flask import Flask, g, jsonify, request
 from waitress import serve
 
 import modules.engine as engine
+from modules.metering import operation_name
 
 
 def handle_query(payload):
@@ -14,6 +19,17 @@ def main():
     h2d = Flask(__name__)
     h2d.json.sort_keys = False
 
+    # Count every authenticated call once the response status is known
+    @h2d.after_request
+    def meter_request(response):
+        if "key_id" in g:
+            engine.meter.record(
+                g.key_id,
+                operation_name(request.args, request.method),
+                response.status_code,
+            )
+        return response
+
     # Handle GET requests
     @h2d.route("/api", methods=["GET"])
     def api_get():
@@ -33,6 +49,7 @@ def main():
 
         # Seems like we have a good user. Fetch the key's info, log the transaction
         key_id, key_type = engine.get_customer_id(request.args.get("apikey"))
+        g.key_id = key_id
         engine.log(request.args, id=key_id)
 
         # Respond to help requests, regardless of key type
@@ -66,6 +83,7 @@ def main():
 
         # Seems like we have a good user. Fetch the key's info
         key_id, key_type = engine.get_customer_id(request.args.get("apikey"))
+        g.key_id = key_id
 
         # POST transactions should only be attempted by admin keys
         if key_type not in ["super", "admin"]:
@@ -85,7 +103,40 @@ def main():
     # Handle DELETE requests
     @h2d.route("/api", methods=["DELETE"])
     def api_del():
-        pass
+        # Before anything else, log unique connection information
+        log_data = f"""IP: {request.environ.get("HTTP_X_FORWARDED_FOR")} - UA: {request.headers.get("User-Agent")}"""
+        engine.log(log_data)
+
+        # Refuse connections with no apikey
+        if "apikey" not in request.args:
+            engine.log("No API key provided. Transaction declined.")
+            return engine.no_api_key(), 401
+
+        # Validate key
+        if not engine.check_key(request.args.get("apikey")):
+            engine.log("Invalid API key provided.")
+            return engine.invalid_key(), 401
+
+        # Seems like we have a good user. Fetch the key's info
+        key_id, key_type = engine.get_customer_id(request.args.get("apikey"))
+        g.key_id = key_id
+
+        # DELETE transactions should only be attempted by admin keys
+        if key_type not in ["super", "admin"]:
+            engine.log("DELETE transaction attempted by unauthorized key.")
+            return engine.admin_required(key_id, key_type, method="DELETE")
+
+        # Log the transaction
+        engine.log(request.args, id=key_id)
+
+        return engine.delete_operation(request.args, key_id), 200
+
+    # Flush usage counters in the background and once more on shutdown
+    engine.meter.start()
+    atexit.register(engine.meter.stop)
+
+    # atexit doesn't run on SIGTERM, so turn a service stop into a normal exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     serve(h2d, host="0.0.0.0", port=32023)
 
@@ -3,21 +3,129 @@ import random
 import re
 import string
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from flask import jsonify
 
 from . import reply
 from .h2database import h2db
+from .metering import UsageMeter
 
 h2db = h2db()
+meter = UsageMeter(h2db)
+
+# Columns bulk operations may select targets by or change
+BULK_TARGET_COLUMNS = ["cust_acct", "cust_license"]
+BULK_SET_COLUMNS = ["cust_acct", "cust_name", "cust_license", "cust_active"]
+
+# Maximum number of targets placed in a single IN (...) clause
+BULK_BATCH_SIZE = 500
+
+# Longest window, in minutes, a usage report can cover (31 days)
+USAGE_MAX_MINUTES = 1440 * 31
+
+
+def batched(values):
+    for i in range(0, len(values), BULK_BATCH_SIZE):
+        yield values[i : i + BULK_BATCH_SIZE]
+
+
+def in_clause(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def customer_dict_query(query_key):
+    return f"""SELECT * FROM customer JOIN apikeys ON customer.cust_id=apikeys.key_id WHERE customer.{query_key}=%s"""
+
+
+def bulk_target_query(column, batch):
+    return f"""SELECT cust_id, {column} FROM customer WHERE {column} IN ({in_clause(batch)}) FOR UPDATE;"""
+
+
+def bulk_update_query(assignments, batch):
+    return f"""UPDATE customer SET {assignments} WHERE cust_id IN ({in_clause(batch)});"""
+
+
+def delete_keys_query(batch):
+    return f"""DELETE FROM apikeys WHERE key_id IN ({in_clause(batch)});"""
+
+
+def delete_customers_query(batch):
+    return f"""DELETE FROM customer WHERE cust_id IN ({in_clause(batch)});"""
+
+
+# Hot lookups are registered with sample arguments so modules.schema can
+# EXPLAIN each one and catch full table scans
+QUERIES = {}
+
+
+def register_query(name, query, sample):
+    QUERIES[name] = (query, sample)
+    return query
+
+
+CUSTOMER_NAME = register_query(
+    "customer_name", """SELECT cust_name FROM customer WHERE cust_id=%s;""", (1,)
+)
+KEY_INFO = register_query(
+    "key_info", """SELECT key_id, key_type FROM apikeys WHERE apikey=%s;""", ("abc1234",)
+)
+KEY_COUNT = register_query(
+    "key_count",
+    """SELECT count(key_id) FROM apikeys WHERE apikey=%s;""",
+    ("abc1234",),
+)
+CUSTOMER_ID_BY_ACCT = register_query(
+    "customer_id_by_acct",
+    """SELECT cust_id FROM customer WHERE cust_acct=%s;""",
+    (10001,),
+)
+LICENSE_BY = {
+    column: register_query(
+        f"license_by_{column}",
+        f"""SELECT cust_license, cust_active FROM customer WHERE {column}=%s;""",
+        ("1",),
+    )
+    for column in ["cust_id", "cust_acct", "cust_license"]
+}
+# Sampled with get_usage's default window so the plan matches real use
+USAGE_SINCE = register_query(
+    "usage_since",
+    """SELECT bucket, key_id, operation, status_class, calls FROM usage_minute WHERE bucket>=%s ORDER BY bucket;""",
+    (datetime.now() - timedelta(minutes=60),),
+)
+USAGE_FOR_KEY_SINCE = register_query(
+    "usage_for_key_since",
+    """SELECT bucket, key_id, operation, status_class, calls FROM usage_minute WHERE key_id=%s AND bucket>=%s ORDER BY bucket;""",
+    (1, datetime.now() - timedelta(minutes=60)),
+)
+
+
+def register_templates():
+    # Queries built per request are registered in a representative form
+    for column in ["cust_id", "cust_acct", "cust_name", "cust_license"]:
+        register_query(f"customer_dict_by_{column}", customer_dict_query(column), ("1",))
+
+    for column in BULK_TARGET_COLUMNS:
+        register_query(
+            f"bulk_targets_by_{column}",
+            bulk_target_query(column, ["1", "2"]),
+            ("1", "2"),
+        )
+
+    register_query(
+        "bulk_update", bulk_update_query("cust_active=%s", [1, 2]), (0, 1, 2)
+    )
+    register_query("delete_keys", delete_keys_query([1, 2]), (1, 2))
+    register_query("delete_customers", delete_customers_query([1, 2]), (1, 2))
+
+
+register_templates()
 
 
 def log(msg, **kwargs):
     if kwargs.get("id"):
-        requestor = h2db.fetch(
-            """SELECT cust_name FROM customer WHERE cust_id=%s;""", (kwargs.get("id"),)
-        )[0]
+        requestor = h2db.fetch(CUSTOMER_NAME, (kwargs.get("id"),))[0]
     else:
         requestor = "SYSTEM MSG"
     with open(f"{os.getcwd()}/h2dapi.log", "a") as f:
@@ -26,27 +134,22 @@ def log(msg, **kwargs):
 
 def get_customer_id(apikey):
     # Fetch key_id with apikey for authentication
-    query = """SELECT key_id, key_type FROM apikeys WHERE apikey=%s;"""
-    response = h2db.fetch(query, (apikey,))
+    response = h2db.fetch(KEY_INFO, (apikey,))
     return response
 
 
 def check_key(apikey):
     # Check apikey is valid
-    query = """SELECT count(key_id) FROM apikeys WHERE apikey=%s;"""
-    return True if h2db.fetch(query, (apikey,))[0] > 0 else False
+    return True if h2db.fetch(KEY_COUNT, (apikey,))[0] > 0 else False
 
 
 def get_customer_dict(query_key, query_value):
-    query = f"""SELECT * FROM customer JOIN apikeys ON customer.cust_id=apikeys.key_id WHERE customer.{query_key}=%s"""
-    return h2db.fetch(query, (query_value,), dictionary=True)
+    return h2db.fetch(customer_dict_query(query_key), (query_value,), dictionary=True)
 
 
 def do_operation(payload, key_id, key_type):
     # Fetch the requestor's account name
-    requestor = h2db.fetch(
-        """SELECT cust_name FROM customer WHERE cust_id=%s;""", (key_id,)
-    )[0]
+    requestor = h2db.fetch(CUSTOMER_NAME, (key_id,))[0]
 
     # Handle query operations
     if payload.get("operation").lower() == "query":
@@ -107,8 +210,15 @@ def do_operation(payload, key_id, key_type):
         else:
             return get_license(payload, key_id)
 
+    # Handle usage reports, which are only available to admin keys
+    elif payload.get("operation").lower() == "usage":
+        if key_type in ["super", "admin"]:
+            return reply.return_query(requestor, get_usage(payload))
+        else:
+            return reply.admin_only(requestor)
+
     # Update operations need to be POST requests. Return an error.
-    elif payload.get("operation").lower() in ["update", "create"]:
+    elif payload.get("operation").lower() in ["update", "create", "bulk_update"]:
         return reply.post_required(requestor)
 
     # Assume error and send a response
@@ -118,9 +228,7 @@ def do_operation(payload, key_id, key_type):
 
 def post_operation(payload, key_id):
     # Translate key_id into customer name
-    requestor = h2db.fetch(
-        """SELECT cust_name FROM customer WHERE cust_id=%s;""", (key_id,)
-    )[0]
+    requestor = h2db.fetch(CUSTOMER_NAME, (key_id,))[0]
 
     # Catch GET operations early
     if payload.get("operation") in ["license", "query"]:
@@ -134,6 +242,10 @@ def post_operation(payload, key_id):
     elif payload.get("operation") == "update":
         return reply.update_account(payload, requestor)
 
+    # Handle updates applied to many accounts at once
+    elif payload.get("operation") == "bulk_update":
+        return bulk_update(payload, key_id, requestor)
+
     # Assume error and send a response
     else:
         return reply.empty_post(requestor)
@@ -159,30 +271,50 @@ def get_license(payload, key_id):
 def admin_get_license(payload, key_id):
     # Verify target info is present or return own license status
     if payload.get("account"):
-        query = """SELECT cust_license, cust_active FROM customer WHERE cust_acct=%s"""
-        info = h2db.fetch(query, (payload.get("account"),), dictionary=True)
+        info = h2db.fetch(
+            LICENSE_BY["cust_acct"], (payload.get("account"),), dictionary=True
+        )
     elif payload.get("license"):
-        query = (
-            """SELECT cust_license, cust_active FROM customer WHERE cust_license=%s"""
+        info = h2db.fetch(
+            LICENSE_BY["cust_license"], (payload.get("license"),), dictionary=True
         )
-        info = h2db.fetch(query, (payload.get("license"),), dictionary=True)
     else:
-        query = """SELECT cust_license, cust_active FROM customer WHERE cust_id=%s"""
-        info = h2db.fetch(query, (key_id,), dictionary=True)
+        info = h2db.fetch(LICENSE_BY["cust_id"], (key_id,), dictionary=True)
 
     return info
 
 
-def admin_required(key_id, key_type):
-    requestor = h2db.fetch(
-        """SELECT cust_name FROM customer WHERE cust_id=%s""", (key_id,)
-    )[0]
+def get_usage(payload):
+    # Read the flushed per-minute counters, optionally for a single key
+    try:
+        minutes = int(payload.get("minutes", 60))
+    except ValueError:
+        minutes = 60
+
+    # Keep the window between one minute and USAGE_MAX_MINUTES
+    minutes = min(max(minutes, 1), USAGE_MAX_MINUTES)
+    since = datetime.now().replace(second=0, microsecond=0) - timedelta(
+        minutes=minutes
+    )
+
+    if payload.get("key_id"):
+        query = USAGE_FOR_KEY_SINCE
+        args = (payload.get("key_id"), since)
+    else:
+        query = USAGE_SINCE
+        args = (since,)
+
+    return h2db.fetch(query, args, dictionary=True, all=True) or []
+
+
+def admin_required(key_id, key_type, method="POST"):
+    requestor = h2db.fetch(CUSTOMER_NAME, (key_id,))[0]
 
     return jsonify(
         {
             "success": False,
             "requestor": requestor,
-            "msg": f"Key type: {key_type} is not permitted to conduct POST operations.",
+            "msg": f"Key type: {key_type} is not permitted to conduct {method} operations.",
             "timestamp": datetime.now(),
         }
     )
@@ -214,10 +346,7 @@ def create_new_account(payload, requestor):
         log(f"Database failure: {query} with {new_data}")
         return reply.db_insert_failure(requestor)
 
-    customer_id = h2db.fetch(
-        """SELECT cust_id FROM customer WHERE cust_acct=%s""",
-        (int(new_data["cust_acct"]),),
-    )[0]
+    customer_id = h2db.fetch(CUSTOMER_ID_BY_ACCT, (int(new_data["cust_acct"]),))[0]
 
     if not h2db.insert(
         """INSERT INTO apikeys VALUES(%s, %s, %s)""",
@@ -232,9 +361,7 @@ def create_new_account(payload, requestor):
 
 def update_customer(payload, key_id):
     # Fetch requestor name
-    requestor = h2db.fetch(
-        """SELECT cust_name FROM customer WHERE cust_id=%s""", (key_id,)
-    )[0]
+    requestor = h2db.fetch(CUSTOMER_NAME, (key_id,))[0]
 
     # If there's no data payload sent, reject
     if not payload.get("data"):
@@ -283,6 +410,202 @@ def update_customer(payload, key_id):
     return reply.update_customer_confirmation(updated_items, new_customer, requestor)
 
 
+def parse_bulk_data(payload):
+    # Bulk requests carry a JSON object in the data field
+    try:
+        data = json.loads(payload.get("data"))
+    except (TypeError, ValueError):
+        return None
+
+    return data if isinstance(data, dict) else None
+
+
+def parse_bulk_targets(data):
+    # Find the single column the targets are selected by
+    columns = [column for column in BULK_TARGET_COLUMNS if column in data]
+    if len(columns) != 1:
+        return None, None
+
+    values = data[columns[0]]
+    if not isinstance(values, list):
+        values = [values]
+
+    # Drop duplicates but keep the order the targets were given in
+    values = list(dict.fromkeys(str(value) for value in values))
+    if not values:
+        return None, None
+
+    # cust_acct is an INT column, anything else would be cast to 0 by MySQL
+    if columns[0] == "cust_acct" and not all(is_int(value) for value in values):
+        return None, None
+
+    # Licenses are plain ASCII. Padding or accents would let the column's
+    # collation match rows that a plain comparison here would not.
+    if columns[0] == "cust_license" and not all(
+        value.isascii() and value == value.strip() for value in values
+    ):
+        return None, None
+
+    return columns[0], values
+
+
+def is_int(value):
+    try:
+        int(value)
+    except ValueError:
+        return False
+
+    return True
+
+
+def target_key(column, value):
+    # Compare values the way MySQL matched them: cust_acct numerically and
+    # ASCII cust_license without regard to case
+    if column == "cust_acct":
+        return int(value)
+
+    return str(value).casefold()
+
+
+def parse_bulk_set(items):
+    # Validate each "column=value" item and collapse them into one change set
+    if not isinstance(items, list) or not items:
+        return None
+
+    changes = {}
+    for item in items:
+        if not isinstance(item, str) or len(item.split("=", 1)) != 2:
+            return None
+
+        column, value = item.split("=", 1)
+        if column not in BULK_SET_COLUMNS:
+            return None
+
+        # Reject values MySQL would refuse or silently cast
+        if column == "cust_active" and value not in ["0", "1"]:
+            return None
+        if column == "cust_acct" and not is_int(value):
+            return None
+
+        changes[column] = value
+
+    return changes
+
+
+def bulk_target_selects(column, values):
+    # One locking SELECT per batch of requested values
+    return [
+        (bulk_target_query(column, batch), tuple(batch)) for batch in batched(values)
+    ]
+
+
+def target_ids(rows, key_id):
+    # Never change the requestor's own account
+    return [row["cust_id"] for row in rows if row["cust_id"] != key_id]
+
+
+def bulk_outcomes(column, rows, key_id, result):
+    # Report every locked row by the value stored in the database
+    outcomes = {}
+    for row in rows:
+        outcomes[str(row[column])] = {
+            "cust_id": row["cust_id"],
+            "result": "skipped_self" if row["cust_id"] == key_id else result,
+        }
+
+    return outcomes
+
+
+def bulk_not_found(column, values, rows):
+    # Requested values that no locked row answers to
+    found = {target_key(column, row[column]) for row in rows}
+    return [value for value in values if target_key(column, value) not in found]
+
+
+def bulk_update(payload, key_id, requestor):
+    data = parse_bulk_data(payload)
+    if data is None:
+        return reply.invalid_bulk_request(requestor)
+
+    column, values = parse_bulk_targets(data)
+    changes = parse_bulk_set(data.get("set"))
+    if not column or not changes:
+        return reply.invalid_bulk_request(requestor)
+
+    # Unique columns can't be set to the same value on more than one account
+    if len(values) > 1 and any(item in BULK_TARGET_COLUMNS for item in changes):
+        return reply.invalid_bulk_request(requestor)
+
+    # Build one multi-column UPDATE per batch of the rows locked by the selects
+    assignments = ", ".join(f"{item}=%s" for item in changes)
+
+    def build(rows):
+        statements = []
+        for batch in batched(target_ids(rows, key_id)):
+            query = bulk_update_query(assignments, batch)
+            statements.append((query, tuple(changes.values()) + tuple(batch)))
+        return statements
+
+    rows = h2db.transaction(bulk_target_selects(column, values), build)
+    if rows is None:
+        log(f"Database failure: bulk update of {column} {values} with {changes}")
+        return reply.db_insert_failure(requestor)
+
+    return reply.bulk_confirmation(
+        requestor,
+        "update",
+        list(changes),
+        bulk_outcomes(column, rows, key_id, "updated"),
+        bulk_not_found(column, values, rows),
+    )
+
+
+def delete_operation(payload, key_id):
+    # Translate key_id into customer name
+    requestor = h2db.fetch(CUSTOMER_NAME, (key_id,))[0]
+
+    # Default to the recoverable option unless removal is asked for
+    mode = (payload.get("mode") or "deactivate").lower()
+    if mode not in ["deactivate", "remove"]:
+        return reply.invalid_delete_request(requestor)
+
+    data = parse_bulk_data(payload)
+    if data is None:
+        return reply.invalid_delete_request(requestor)
+
+    column, values = parse_bulk_targets(data)
+    if not column:
+        return reply.invalid_delete_request(requestor)
+
+    def build(rows):
+        statements = []
+        for batch in batched(target_ids(rows, key_id)):
+            if mode == "deactivate":
+                statements.append(
+                    (bulk_update_query("cust_active=%s", batch), (0,) + tuple(batch))
+                )
+            else:
+                # Keys go first so no apikey is left pointing at a missing customer
+                statements.append((delete_keys_query(batch), tuple(batch)))
+                statements.append((delete_customers_query(batch), tuple(batch)))
+        return statements
+
+    rows = h2db.transaction(bulk_target_selects(column, values), build)
+    if rows is None:
+        log(f"Database failure: bulk {mode} of {column} {values}")
+        return reply.db_insert_failure(requestor)
+
+    return reply.bulk_confirmation(
+        requestor,
+        mode,
+        [],
+        bulk_outcomes(
+            column, rows, key_id, "deactivated" if mode == "deactivate" else "removed"
+        ),
+        bulk_not_found(column, values, rows),
+    )
+
+
 def create_new_apikey():
     return random.choices(string.ascii_letters + string.digits, k=64)
 
@@ -294,5 +617,7 @@ def help(payload):
         return jsonify(reply.query_help())
     elif re.search(r"update", payload.get("help").lower()):
         return jsonify(reply.update_help())
+    elif re.search(r"usage", payload.get("help").lower()):
+        return jsonify(reply.usage_help())
     else:
         return jsonify(reply.empty_help())
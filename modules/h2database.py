@@ -74,3 +74,54 @@ class h2db:
             # Clean up connection and return response
             db.close()
             return response
+
+    def transaction(self, selects, build):
+        # Run the selects, then the writes build() makes from their rows, on
+        # one connection as a single unit. Returns the selected rows.
+        db = self.connect()
+        c = db.cursor(dictionary=True)
+
+        try:
+            rows = []
+            for query, args in selects:
+                c.execute(query, args)
+                rows.extend(c.fetchall())
+
+            for query, args in build(rows):
+                c.execute(query, args)
+            db.commit()
+
+            response = rows
+        except Exception as e:
+            # Undo the partial work and log the information
+            db.rollback()
+            with open(f"{os.getcwd()}/h2dapi.log", "a") as f:
+                f.write(f"{datetime.now()} - ERROR! - {str(e)}\n")
+
+            response = None
+        finally:
+            # Clean up connection and return response
+            db.close()
+            return response
+
+    def insert_many(self, query, rows):
+        # Connect to the database and send every row in one batch
+        db = self.connect()
+        c = db.cursor()
+
+        try:
+            c.executemany(query, rows)
+            db.commit()
+
+            response = True
+        except Exception as e:
+            # If an error is encountered, log the information
+            db.rollback()
+            with open(f"{os.getcwd()}/h2dapi.log", "a") as f:
+                f.write(f"{datetime.now()} - ERROR! - {str(e)}\n")
+
+            response = False
+        finally:
+            # Clean up connection and return response
+            db.close()
+            return response
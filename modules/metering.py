@@ -0,0 +1,124 @@
+import os
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+from .schema import TABLES
+
+# Operations tracked by name. Anything else is counted as "other" so
+# arbitrary request input can't grow the counters without bound.
+OPERATIONS = [
+    "query",
+    "license",
+    "create",
+    "update",
+    "bulk_update",
+    "usage",
+    "help",
+    "delete",
+    "none",
+]
+
+# How often, in seconds, pending counts are written to the database
+FLUSH_INTERVAL = 60
+
+# Rows sent per executemany() call
+FLUSH_BATCH_SIZE = 500
+
+# Limits on counts kept for retry while the database can't be written to
+RETAIN_MINUTES = 60
+RETAIN_MAX_KEYS = 100000
+
+FLUSH_QUERY = """INSERT INTO usage_minute (bucket, key_id, operation, status_class, calls)
+VALUES (%s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE calls=calls+VALUES(calls);"""
+
+
+def operation_name(payload, method):
+    # Reduce a request to one of the tracked operation names
+    if method == "DELETE":
+        return "delete"
+    if "help" in payload and "operation" not in payload:
+        return "help"
+    if "operation" not in payload:
+        return "none"
+
+    operation = payload.get("operation").lower()
+    return operation if operation in OPERATIONS else "other"
+
+
+def status_class(status_code):
+    return f"{status_code // 100}xx"
+
+
+class UsageMeter:
+    def __init__(self, db):
+        self.db = db
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def record(self, key_id, operation, status_code):
+        # Counts are kept per minute so a flush only ever adds to a bucket
+        bucket = datetime.now().replace(second=0, microsecond=0)
+        with self.lock:
+            self.counts[(bucket, key_id, operation, status_class(status_code))] += 1
+
+    def flush(self):
+        # Swap the counters out under the lock and write them without it
+        with self.lock:
+            pending, self.counts = self.counts, Counter()
+
+        if not pending:
+            return True
+
+        rows = [key + (calls,) for key, calls in pending.items()]
+        for i in range(0, len(rows), FLUSH_BATCH_SIZE):
+            if not self.db.insert_many(FLUSH_QUERY, rows[i : i + FLUSH_BATCH_SIZE]):
+                # Put back what wasn't written so the next flush retries it
+                with self.lock:
+                    for row in rows[i:]:
+                        self.counts[row[:4]] += row[4]
+                    dropped = self.trim()
+
+                if dropped:
+                    with open(f"{os.getcwd()}/h2dapi.log", "a") as f:
+                        f.write(
+                            f"{datetime.now()} - ERROR! - Usage flush failing, dropped {dropped} calls\n"
+                        )
+                return False
+
+        return True
+
+    def trim(self):
+        # Drop buckets that are too old, then the oldest buckets until the
+        # key limit is met. Called with the lock held. Returns calls dropped.
+        cutoff = datetime.now() - timedelta(minutes=RETAIN_MINUTES)
+        drop = [key for key in self.counts if key[0] < cutoff]
+
+        excess = len(self.counts) - len(drop) - RETAIN_MAX_KEYS
+        if excess > 0:
+            kept = sorted(key for key in self.counts if key[0] >= cutoff)
+            drop += kept[:excess]
+
+        return sum(self.counts.pop(key) for key in drop)
+
+    def run(self):
+        while not self.stop_event.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def start(self):
+        # Make sure there is somewhere to flush to before counting anything
+        if not self.db.insert(TABLES["usage_minute"]):
+            raise RuntimeError("usage_minute table could not be created, see h2dapi.log")
+
+        self.thread = threading.Thread(target=self.run, name="usage-flush", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Stop the background task and write whatever is still pending
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
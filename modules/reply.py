@@ -40,6 +40,20 @@ def update_help():
     }
 
 
+def usage_help():
+    return {
+        "success": True,
+        "help": "The usage operation requires an admin or higher access apikey. Returns per-minute call counts by key_id, operation and status class. 'minutes' sets how far back to look (default 60, at most 44640) and 'key_id' limits the report to one key. Counts are written to the database about once a minute.",
+        "example": {
+            "operation": "usage",
+            "apikey": "abc1234",
+            "minutes": 120,
+            "key_id": 12,
+        },
+        "timestamp": datetime.now(),
+    }
+
+
 def empty_help():
     return {
         "success": False,
@@ -114,6 +128,17 @@ def self_interrogation_only(requestor):
     )
 
 
+def admin_only(requestor):
+    return jsonify(
+        {
+            "success": False,
+            "requestor": requestor,
+            "msg": "This operation is only available to admin keys.",
+            "timestamp": datetime.now(),
+        }
+    )
+
+
 def post_required(requestor):
     return jsonify(
         {
@@ -236,3 +261,52 @@ def update_customer_confirmation(updated, customer, requestor):
             "timestamp": datetime.now(),
         }
     )
+
+
+def invalid_bulk_request(requestor):
+    return jsonify(
+        {
+            "success": False,
+            "requestor": requestor,
+            "msg": "A bulk update requires a JSON 'data' field listing targets by either cust_acct or cust_license and a 'set' list of changes. cust_active must be 0 or 1, cust_acct must be a number and licenses must be plain ASCII without surrounding spaces. cust_acct and cust_license can only be set when a single target is given.",
+            "example": {
+                "operation": "bulk_update",
+                "apikey": "abc1234",
+                "data": {
+                    "cust_acct": ["10001", "10002"],
+                    "set": ["cust_active=0"],
+                },
+            },
+            "timestamp": datetime.now(),
+        }
+    )
+
+
+def invalid_delete_request(requestor):
+    return jsonify(
+        {
+            "success": False,
+            "requestor": requestor,
+            "msg": "A DELETE requires a JSON 'data' field listing targets by either cust_acct or cust_license. Licenses must be plain ASCII without surrounding spaces. 'mode' may be 'deactivate' (default) or 'remove'.",
+            "example": {
+                "apikey": "abc1234",
+                "mode": "deactivate",
+                "data": {"cust_license": ["1234abcd", "5678efgh"]},
+            },
+            "timestamp": datetime.now(),
+        }
+    )
+
+
+def bulk_confirmation(requestor, operation, updated, outcomes, not_found):
+    return jsonify(
+        {
+            "success": True,
+            "requestor": requestor,
+            "operation": operation,
+            "updated": updated,
+            "results": outcomes,
+            "not_found": not_found,
+            "timestamp": datetime.now(),
+        }
+    )
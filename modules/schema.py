@@ -0,0 +1,158 @@
+import argparse
+import sys
+
+from .h2database import h2db
+
+h2db = h2db()
+
+# Tables in creation order. apikeys.key_id is the owning customer's cust_id,
+# and a customer may hold more than one key.
+TABLES = {
+    "customer": """CREATE TABLE IF NOT EXISTS customer (
+    cust_id INT NOT NULL AUTO_INCREMENT,
+    cust_acct INT NOT NULL,
+    cust_name VARCHAR(255) NOT NULL,
+    cust_license VARCHAR(64) NOT NULL,
+    cust_active TINYINT NOT NULL DEFAULT 1,
+    PRIMARY KEY (cust_id),
+    UNIQUE KEY cust_acct (cust_acct),
+    UNIQUE KEY cust_license (cust_license),
+    KEY cust_name (cust_name)
+);""",
+    "apikeys": """CREATE TABLE IF NOT EXISTS apikeys (
+    key_id INT NOT NULL,
+    apikey VARCHAR(64) NOT NULL,
+    key_type VARCHAR(16) NOT NULL,
+    KEY key_id (key_id),
+    UNIQUE KEY apikey (apikey)
+);""",
+    "usage_minute": """CREATE TABLE IF NOT EXISTS usage_minute (
+    bucket DATETIME NOT NULL,
+    key_id INT NOT NULL,
+    operation VARCHAR(32) NOT NULL,
+    status_class CHAR(3) NOT NULL,
+    calls INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, key_id, operation, status_class),
+    KEY key_bucket (key_id, bucket)
+);""",
+}
+
+# Indexes the engine relies on, added to tables that predate this module
+# Each entry is (table, leading column, index name, unique, change). An index
+# of any name leading with the column counts; unique entries also need a
+# unique index on that column alone.
+INDEXES = [
+    ("customer", "cust_id", "PRIMARY", True, "ADD PRIMARY KEY (cust_id)"),
+    ("customer", "cust_acct", "cust_acct", True, "ADD UNIQUE KEY cust_acct (cust_acct)"),
+    (
+        "customer",
+        "cust_license",
+        "cust_license",
+        True,
+        "ADD UNIQUE KEY cust_license (cust_license)",
+    ),
+    ("customer", "cust_name", "cust_name", False, "ADD KEY cust_name (cust_name)"),
+    ("apikeys", "key_id", "key_id", False, "ADD KEY key_id (key_id)"),
+    ("apikeys", "apikey", "apikey", True, "ADD UNIQUE KEY apikey (apikey)"),
+    (
+        "usage_minute",
+        "key_id",
+        "key_bucket",
+        False,
+        "ADD KEY key_bucket (key_id, bucket)",
+    ),
+]
+
+# EXPLAIN access types that read every row of a table or index
+FULL_SCANS = ["ALL", "index"]
+
+
+def leading_indexes(table, column):
+    # Every index whose first column is the given column, with its uniqueness
+    # and column count. Returns None when information_schema can't be read.
+    query = """SELECT s.index_name AS index_name, s.non_unique AS non_unique, (SELECT count(*) FROM information_schema.statistics t WHERE t.table_schema=s.table_schema AND t.table_name=s.table_name AND t.index_name=s.index_name) AS column_count FROM information_schema.statistics s WHERE s.table_schema=DATABASE() AND s.table_name=%s AND s.column_name=%s AND s.seq_in_index=1;"""
+    return h2db.fetch(query, (table, column), dictionary=True, all=True)
+
+
+def migrate():
+    # Create missing tables, then add any index an older table is missing
+    ok = True
+    for table, query in TABLES.items():
+        if not h2db.insert(query):
+            print(f"FAILED creating {table}")
+            ok = False
+
+    for table, column, index, unique, change in INDEXES:
+        indexes = leading_indexes(table, column)
+        if indexes is None:
+            print(f"FAILED checking {index} on {table}, see h2dapi.log")
+            ok = False
+            continue
+
+        if unique:
+            matches = [
+                row
+                for row in indexes
+                if int(row["non_unique"]) == 0 and int(row["column_count"]) == 1
+            ]
+        else:
+            matches = indexes
+        if matches:
+            continue
+
+        # Don't accept, or try to re-add, a same-named index that isn't unique
+        if any(row["index_name"] == index for row in indexes):
+            print(
+                f"FAILED {index} on {table} exists but is not a unique index on {column}"
+            )
+            ok = False
+            continue
+
+        # A unique index fails here if the table already holds duplicates
+        if h2db.insert(f"""ALTER TABLE {table} {change};"""):
+            print(f"Added {index} on {table}")
+        else:
+            print(f"FAILED adding {index} on {table}, see h2dapi.log")
+            ok = False
+
+    return ok
+
+
+def check():
+    # EXPLAIN every registered engine query and report any full scans.
+    # Imported here since engine's metering imports this module.
+    from . import engine
+
+    ok = True
+    for name, (query, sample) in engine.QUERIES.items():
+        plan = h2db.fetch(f"""EXPLAIN {query}""", sample, dictionary=True, all=True)
+        if plan is None:
+            print(f"FAILED {name}: EXPLAIN errored, see h2dapi.log")
+            ok = False
+            continue
+
+        scans = [row["table"] for row in plan if row["type"] in FULL_SCANS]
+        if scans:
+            print(f"FAILED {name}: full scan on {', '.join(scans)}")
+            ok = False
+        else:
+            print(f"ok {name}")
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the H2D API database schema")
+    parser.add_argument(
+        "command",
+        choices=["migrate", "check"],
+        help="migrate creates tables and indexes, check EXPLAINs the engine queries",
+    )
+    args = parser.parse_args()
+
+    ok = migrate() if args.command == "migrate" else check()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()